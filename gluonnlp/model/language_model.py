@@ -138,20 +138,51 @@ class AWDRNN(Block):
         out_states: list
             The list of output states of the model's encoder.
         """
+        out, out_states, _, _ = self.forward_with_encoded(inputs, begin_state)
+        return out, out_states
+
+    def forward_with_encoded(self, inputs, begin_state=None):
+        """Implement forward computation, also returning the outputs of the encoder.
+
+        The encoder outputs are needed for activation regularization during training.
+
+        Parameters
+        ----------
+        inputs : NDArray
+            The training dataset.
+        begin_state : list
+            The initial hidden states.
+
+        Returns
+        -------
+        out: NDArray
+            The output of the model.
+        out_states: list
+            The list of output states of the model's encoder.
+        encoded_raw: list
+            The list of outputs of the model's encoder.
+        encoded_dropped: list
+            The list of outputs with dropout of the model's encoder.
+        """
         encoded = self.embedding(inputs)
         if not begin_state:
             begin_state = self.begin_state(batch_size=inputs.shape[1])
         out_states = []
+        encoded_raw = []
+        encoded_dropped = []
         for i, (e, s) in enumerate(zip(self.encoder, begin_state)):
             encoded, state = e(encoded, s)
+            encoded_raw.append(encoded)
             out_states.append(state)
             if self._drop_h and i != len(self.encoder)-1:
                 encoded = nd.Dropout(encoded, p=self._drop_h, axes=(0,))
+                encoded_dropped.append(encoded)
         if self._dropout:
             encoded = nd.Dropout(encoded, p=self._dropout, axes=(0,))
+        encoded_dropped.append(encoded)
         with autograd.predict_mode():
             out = self.decoder(encoded)
-        return out, out_states
+        return out, out_states, encoded_raw, encoded_dropped
 
 
 class StandardRNN(Block):
@@ -224,14 +255,22 @@ class StandardRNN(Block):
     def forward(self, inputs, begin_state=None): # pylint: disable=arguments-differ
         """Defines the forward computation. Arguments can be either
         :py:class:`NDArray` or :py:class:`Symbol`."""
+        out, state, _, _ = self.forward_with_encoded(inputs, begin_state)
+        return out, state
+
+    def forward_with_encoded(self, inputs, begin_state=None):
+        """Defines the forward computation, also returning the list of outputs of the
+        encoder and the (empty) list of outputs with dropout of the encoder, as in
+        :py:meth:`AWDRNN.forward_with_encoded`."""
         encoded = self.embedding(inputs)
         if not begin_state:
             begin_state = self.begin_state(batch_size=inputs.shape[1])
         encoded, state = self.encoder(encoded, begin_state)
+        encoded_raw = [encoded]
         if self._dropout:
             encoded = nd.Dropout(encoded, p=self._dropout, axes=(0,))
         out = self.decoder(encoded)
-        return out, state
+        return out, state, encoded_raw, []
 
 def _load_vocab(dataset_name, vocab, root):
     if dataset_name:
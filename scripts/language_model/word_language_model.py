@@ -39,10 +39,12 @@ Our implementation should yield identical results.
 # under the License.
 
 import argparse
+import collections
 import time
 import math
 import os
 import sys
+import numpy as np
 import mxnet as mx
 from mxnet import gluon, autograd
 import gluonnlp as nlp
@@ -108,18 +110,44 @@ parser.add_argument('--beta', type=float, default=1,
                          '(beta = 0 means no regularization)')
 parser.add_argument('--test_mode', action='store_true',
                     help='Whether to run through the script with few examples')
+parser.add_argument('--accum_steps', type=int, default=1,
+                    help='number of batches over which gradients are accumulated before each '
+                         'parameter update. Each update uses the learning rate scaled by the '
+                         'sequence length of its last batch only, so values above 1 deviate '
+                         'from the per-batch learning rate scaling of the AWD recipe.')
+parser.add_argument('--horovod', action='store_true',
+                    help='Whether to use horovod for data-parallel training, with one process '
+                         'per GPU. The batch size is split evenly across processes.')
 args = parser.parse_args()
 
 ###############################################################################
 # Load data
 ###############################################################################
 
-context = [mx.cpu()] if args.gpus is None or args.gpus == '' else \
-          [mx.gpu(int(x)) for x in args.gpus.split(',')]
+# Seed of the dedicated generator for the BPTT lengths, so that the schedule is the same
+# on every run.
+bptt_seed = 0
+
+if args.horovod:
+    import horovod.mxnet as hvd
+    hvd.init()
+    assert args.batch_size % hvd.size() == 0, \
+        'Total batch size must be multiple of the number of horovod processes'
+    context = [mx.gpu(hvd.local_rank())]
+    # Ranks allreduce every step, so they must all sample the same BPTT schedule.
+    bptt_seed = int(hvd.broadcast(mx.nd.array([bptt_seed], ctx=context[0]), root_rank=0,
+                                  name='bptt_seed').asscalar())
+else:
+    context = [mx.cpu()] if args.gpus is None or args.gpus == '' else \
+              [mx.gpu(int(x)) for x in args.gpus.split(',')]
 
 assert args.batch_size % len(context) == 0, \
     'Total batch size must be multiple of the number of devices'
 
+assert args.accum_steps >= 1, 'The number of accumulation steps must be at least 1'
+
+bptt_rng = np.random.RandomState(bptt_seed)
+
 assert args.weight_dropout > 0 or (args.weight_dropout == 0 and args.alpha == 0), \
     'The alpha L2 regularization cannot be used with standard RNN, please set alpha to 0'
 
@@ -145,6 +173,11 @@ if args.test_mode:
     val_data = val_data[0:100]
     test_data = test_data[0:100]
 
+if args.horovod:
+    rank_batch_size = args.batch_size // hvd.size()
+    train_data = mx.nd.slice_axis(train_data, axis=1, begin=hvd.rank() * rank_batch_size,
+                                  end=(hvd.rank() + 1) * rank_batch_size)
+
 print(args)
 
 ###############################################################################
@@ -165,6 +198,8 @@ else:
                                                  args.nhid, args.nlayers, args.dropout, args.tied)
 
 model.initialize(mx.init.Xavier(), ctx=context)
+if args.accum_steps > 1:
+    model.collect_params().setattr('grad_req', 'add')
 
 if args.optimizer == 'sgd':
     trainer_params = {'learning_rate': args.lr,
@@ -177,9 +212,60 @@ elif args.optimizer == 'adam':
                       'beta2': 0.999,
                       'epsilon': 1e-9}
 
-trainer = gluon.Trainer(model.collect_params(), args.optimizer, trainer_params)
+if args.horovod:
+    hvd.broadcast_parameters(model.collect_params(), root_rank=0)
+    trainer = hvd.DistributedTrainer(model.collect_params(), args.optimizer, trainer_params)
+else:
+    trainer = gluon.Trainer(model.collect_params(), args.optimizer, trainer_params)
 loss = gluon.loss.SoftmaxCrossEntropyLoss()
 
+
+class ActivationRegularizationLoss(gluon.HybridBlock):
+    """Activation regularization (AR) and temporal activation regularization (TAR).
+
+    Both terms are computed in a single hybridized graph, so that they are dispatched as
+    one cached operator call per step.
+
+    Parameters
+    ----------
+    alpha : float
+        Weight of the L2 regularization on the dropped output of the encoder.
+    beta : float
+        Weight of the slowness regularization on the raw output of the encoder.
+    """
+    def __init__(self, alpha, beta, **kwargs):
+        super(ActivationRegularizationLoss, self).__init__(**kwargs)
+        self._alpha = alpha
+        self._beta = beta
+
+    def hybrid_forward(self, F, encoder_h, dropped_encoder_h): # pylint: disable=arguments-differ
+        """Compute the weighted sum of the regularization terms.
+
+        Parameters
+        ----------
+        encoder_h : NDArray or Symbol
+            The raw output of the last encoder layer, with shape (T, N, C).
+        dropped_encoder_h : NDArray or Symbol
+            The output of the last encoder layer after dropout, with shape (T, N, C).
+
+        Returns
+        -------
+        l : NDArray or Symbol
+            The regularization loss, with shape (1,).
+        """
+        terms = []
+        if self._alpha:
+            terms.append(self._alpha * F.mean(F.square(dropped_encoder_h)))
+        if self._beta:
+            diff = F.slice_axis(encoder_h, axis=0, begin=1, end=None) - \
+                   F.slice_axis(encoder_h, axis=0, begin=0, end=-1)
+            terms.append(self._beta * F.mean(F.square(diff)))
+        return F.add_n(*terms)
+
+
+regularizer = ActivationRegularizationLoss(args.alpha, args.beta)
+regularizer.hybridize()
+
 ###############################################################################
 # Training code
 ###############################################################################
@@ -190,11 +276,81 @@ def get_batch(data_source, i, seq_len=None):
     target = data_source[i+1:i+1+seq_len]
     return data, target
 
+def variable_bptt_batches(data_source, rng):
+    """Sample the start position and length of each training batch.
+
+    The base sequence length is args.bptt with probability 0.95 and args.bptt / 2
+    otherwise, and is perturbed by normal noise with standard deviation 5.
+
+    Parameters
+    ----------
+    data_source : NDArray
+        The batchified dataset.
+    rng : numpy.random.RandomState
+        The generator to sample the sequence lengths from.
+
+    Returns
+    -------
+    batches: generator of (int, int)
+        The start position and sampled sequence length of each batch.
+    """
+    i, end = 0, len(data_source) - 1 - 1
+    while i < end:
+        bptt = args.bptt if rng.uniform() < 0.95 else args.bptt / 2
+        seq_len = max(5, int(rng.normal(bptt, 5)))
+        yield i, seq_len
+        i += seq_len
+
+def prefetch(data_source, batches, ctx_list, depth=2):
+    """Load batches onto the devices ahead of their use.
+
+    The copies of up to `depth` batches are issued before a batch is returned, so that
+    host-to-device transfers overlap with the computation on the previous batches.
+
+    Parameters
+    ----------
+    data_source : NDArray
+        The batchified dataset.
+    batches : iterable of (int, int)
+        The start position and sequence length of each batch.
+    ctx_list : list of Context
+        The contexts to split each batch onto, along the batch axis.
+    depth : int, default 2
+        The number of batches in flight.
+
+    Returns
+    -------
+    batches: generator of (int, list of NDArray, list of NDArray)
+        The sequence length, data list and target list of each batch.
+    """
+    queue = collections.deque()
+    for i, seq_len in batches:
+        data, target = get_batch(data_source, i, seq_len=seq_len)
+        queue.append((seq_len,
+                      gluon.utils.split_and_load(data, ctx_list, batch_axis=1, even_split=True),
+                      gluon.utils.split_and_load(target, ctx_list, batch_axis=1,
+                                                 even_split=True)))
+        if len(queue) == depth:
+            yield queue.popleft()
+    while queue:
+        yield queue.popleft()
+
 def detach(hidden):
-    if isinstance(hidden, (tuple, list)):
-        hidden = [detach(h) for h in hidden]
-    else:
-        hidden = hidden.detach()
+    """Detach the hidden states from the computation graph.
+
+    The states are replaced in place in their lists, so that the nested structure built by
+    begin_state is reused across batches instead of being rebuilt recursively.
+    """
+    if isinstance(hidden, mx.nd.NDArray):
+        return hidden.detach()
+    pending = [hidden]
+    while pending:
+        states = pending.pop()
+        for i, h in enumerate(states):
+            if isinstance(h, mx.nd.NDArray):
+                states[i] = h.detach()
+            else:
+                pending.append(h)
     return hidden
 
 def evaluate(data_source, batch_size, ctx=None):
@@ -214,73 +370,20 @@ def evaluate(data_source, batch_size, ctx=None):
     loss: float
         The loss on the dataset
     """
-    total_L = 0.0
+    total_L = mx.nd.zeros((1,), ctx=ctx, dtype='float64')
     ntotal = 0
     hidden = model.begin_state(batch_size, func=mx.nd.zeros, ctx=context[0])
-    for i in range(0, len(data_source) - 1, args.bptt):
-        data, target = get_batch(data_source, i)
-        data = data.as_in_context(ctx)
-        target = target.as_in_context(ctx)
+    batches = ((i, args.bptt) for i in range(0, len(data_source) - 1, args.bptt))
+    for _, (data,), (target,) in prefetch(data_source, batches, [ctx]):
         output, hidden = model(data, hidden)
         hidden = detach(hidden)
         L = loss(output.reshape(-3, -1),
                  target.reshape(-1,))
-        total_L += mx.nd.sum(L).asscalar()
+        total_L += mx.nd.sum(L).astype('float64')
         ntotal += L.size
-    return total_L / ntotal
+    return total_L.asscalar() / ntotal
 
 
-def forward(inputs, begin_state=None):
-    """Implement forward computation using awd language model.
-
-    Parameters
-    ----------
-    inputs : NDArray
-        The training dataset.
-    begin_state : list
-        The initial hidden states.
-
-    Returns
-    -------
-    out: NDArray
-        The output of the model.
-    out_states: list
-        The list of output states of the model's encoder.
-    encoded_raw: list
-        The list of outputs of the model's encoder.
-    encoded_dropped: list
-        The list of outputs with dropout of the model's encoder.
-    """
-    encoded = model.embedding(inputs)
-    if not begin_state:
-        begin_state = model.begin_state(batch_size=inputs.shape[1])
-    out_states = []
-    encoded_raw = []
-    encoded_dropped = []
-    if args.weight_dropout > 0:
-        for i, (e, s) in enumerate(zip(model.encoder, begin_state)):
-            encoded, state = e(encoded, s)
-            encoded_raw.append(encoded)
-            out_states.append(state)
-            if model._drop_h and i != len(model.encoder)-1:
-                encoded = mx.nd.Dropout(encoded, p=model._drop_h, axes=(0,))
-                encoded_dropped.append(encoded)
-    else:
-        encoded, state = model.encoder(encoded, begin_state)
-        encoded_raw.append(encoded)
-    if model._dropout:
-        encoded = mx.nd.Dropout(encoded, p=model._dropout, axes=(0,))
-    if args.weight_dropout > 0:
-        encoded_dropped.append(encoded)
-        with autograd.predict_mode():
-            out = model.decoder(encoded)
-    else:
-        out = model.decoder(encoded)
-    if args.weight_dropout > 0:
-        return out, out_states, encoded_raw, encoded_dropped
-    else:
-        return out, state, encoded_raw, encoded_dropped
-
 def criterion(output, target, encoder_hs, dropped_encoder_hs):
     """Compute regularized (optional) loss of the language model in training mode.
 
@@ -304,14 +407,11 @@ def criterion(output, target, encoder_hs, dropped_encoder_hs):
             If args.beta is not zero, the standard loss is regularized with temporal activation.
     """
     l = loss(output.reshape(-3, -1), target.reshape(-1,))
-    if args.alpha:
-        dropped_means = [args.alpha*dropped_encoder_h.__pow__(2).mean()
-                         for dropped_encoder_h in dropped_encoder_hs[-1:]]
-        l = l + mx.nd.add_n(*dropped_means)
-    if args.beta:
-        means = [args.beta*(encoder_h[1:] - encoder_h[:-1]).__pow__(2).mean()
-                 for encoder_h in encoder_hs[-1:]]
-        l = l + mx.nd.add_n(*means)
+    if args.alpha or args.beta:
+        # StandardRNN has no dropped encoder outputs; alpha is then asserted to be zero and
+        # the second input is ignored.
+        l = l + regularizer(encoder_hs[-1],
+                            dropped_encoder_hs[-1] if dropped_encoder_hs else encoder_hs[-1])
     return l
 
 def train():
@@ -320,51 +420,73 @@ def train():
     """
     best_val = float('Inf')
     start_train_time = time.time()
-    parameters = model.collect_params().values()
+    params = model.collect_params()
+    parameters = params.values()
+    num_batches = len(train_data) // args.bptt
+    ctx_batch_size = train_data.shape[1] // len(context)
+    grads = None
+    num_accumulated = 0
     for epoch in range(args.epochs):
-        total_L = 0.0
+        total_L = mx.nd.zeros((1,), ctx=context[0], dtype='float64')
         start_epoch_time = time.time()
         start_log_interval_time = time.time()
-        hiddens = [model.begin_state(args.batch_size//len(context),
-                                     func=mx.nd.zeros, ctx=ctx) for ctx in context]
-        batch_i, i = 0, 0
-        while i < len(train_data) - 1 - 1:
-            bptt = args.bptt if mx.nd.random.uniform().asscalar() < 0.95 else args.bptt / 2
-            seq_len = max(5, int(mx.nd.random.normal(bptt, 5).asscalar()))
+        hiddens = [model.begin_state(ctx_batch_size, func=mx.nd.zeros, ctx=ctx)
+                   for ctx in context]
+        batch_i = 0
+        batches = variable_bptt_batches(train_data, bptt_rng)
+        for seq_len, data_list, target_list in prefetch(train_data, batches, context):
             lr_batch_start = trainer.learning_rate
             trainer.set_learning_rate(lr_batch_start*seq_len/args.bptt)
 
-            data, target = get_batch(train_data, i, seq_len=seq_len)
-            data_list = gluon.utils.split_and_load(data, context, batch_axis=1, even_split=True)
-            target_list = gluon.utils.split_and_load(target, context, batch_axis=1, even_split=True)
             hiddens = detach(hiddens)
             Ls = []
             L = 0
             with autograd.record():
                 for j, (X, y, h) in enumerate(zip(data_list, target_list, hiddens)):
-                    output, h, encoder_hs, dropped_encoder_hs = forward(X, h)
+                    output, h, encoder_hs, dropped_encoder_hs = model.forward_with_encoded(X, h)
                     l = criterion(output, y, encoder_hs, dropped_encoder_hs)
                     L = L + l.as_in_context(context[0]) / X.size
                     Ls.append(l/X.size)
                     hiddens[j] = h
             L.backward()
-            grads = [p.grad(d.context) for p in parameters for d in data_list]
-            gluon.utils.clip_global_norm(grads, args.clip)
-
-            trainer.step(1)
-
-            total_L += sum([mx.nd.sum(L).asscalar() for L in Ls])
+            num_accumulated += 1
+            if num_accumulated == args.accum_steps:
+                if grads is None:
+                    # Gradient buffers persist across steps; collect them once the deferred
+                    # parameters have been initialized by the first forward pass.
+                    grads = [p.grad(ctx) for ctx in context
+                             for p in parameters if p.grad_req != 'null']
+                # The buffers hold the sum over the accumulated batches, so clipping it at
+                # args.clip * args.accum_steps clips their average at args.clip.
+                clip = args.clip * args.accum_steps
+                if args.horovod:
+                    # Clip the gradient aggregated over all processes, as the multi-device
+                    # path does. The allreduced buffers hold the sum over processes, which
+                    # DistributedTrainer averages in update().
+                    trainer.allreduce_grads()
+                    clip *= hvd.size()
+                gluon.utils.clip_global_norm(grads, clip)
+
+                if args.horovod:
+                    trainer.update(args.accum_steps)
+                else:
+                    trainer.step(args.accum_steps)
+                if args.accum_steps > 1:
+                    params.zero_grad()
+                num_accumulated = 0
+
+            total_L += mx.nd.add_n(*[mx.nd.sum(L).as_in_context(context[0])
+                                     for L in Ls]).astype('float64')
             trainer.set_learning_rate(lr_batch_start)
             if batch_i % args.log_interval == 0 and batch_i > 0:
-                cur_L = total_L / args.log_interval
+                cur_L = total_L.asscalar() / args.log_interval
                 print('[Epoch %d Batch %d/%d] loss %.2f, ppl %.2f, '
                       'throughput %.2f samples/s, lr %.2f'
-                      %(epoch, batch_i, len(train_data)//args.bptt, cur_L, math.exp(cur_L),
+                      %(epoch, batch_i, num_batches, cur_L, math.exp(cur_L),
                         args.batch_size*args.log_interval/(time.time()-start_log_interval_time),
                         lr_batch_start*seq_len/args.bptt))
-                total_L = 0.0
+                total_L[:] = 0
                 start_log_interval_time = time.time()
-            i += seq_len
             batch_i += 1
 
         mx.nd.waitall()
@@ -379,7 +501,8 @@ def train():
             update_lr_epoch = 0
             best_val = val_L
             test_L = evaluate(test_data, test_batch_size, context[0])
-            model.save_params(args.save)
+            if not args.horovod or hvd.rank() == 0:
+                model.save_params(args.save)
             print('test loss %.2f, test ppl %.2f'%(test_L, math.exp(test_L)))
         else:
             update_lr_epoch += 1
@@ -397,7 +520,14 @@ if __name__ == '__main__':
     start_pipeline_time = time.time()
     if not args.eval_only:
         train()
-    model.load_params(args.save, context)
+    if args.horovod:
+        # Only rank 0 writes the checkpoint, possibly on another node, so it alone loads it
+        # and broadcasts the parameters. The broadcast also waits for all ranks.
+        if hvd.rank() == 0:
+            model.load_params(args.save, context)
+        hvd.broadcast_parameters(model.collect_params(), root_rank=0)
+    else:
+        model.load_params(args.save, context)
     final_val_L = evaluate(val_data, val_batch_size, context[0])
     final_test_L = evaluate(test_data, test_batch_size, context[0])
     print('Best validation loss %.2f, val ppl %.2f'%(final_val_L, math.exp(final_val_L)))
@@ -51,3 +51,19 @@ def test_text_models():
             model.collect_params().initialize()
         output, state = model(mx.nd.arange(330).reshape(33, 10))
         output.wait_to_read()
+
+
+def test_language_model_forward_with_encoded():
+    vocab_size = 20
+    inputs = mx.nd.arange(30).reshape(6, 5) % vocab_size
+    for model, num_raw, num_dropped in [(nlp.model.AWDRNN('lstm', vocab_size, 16, 16, 2), 2, 2),
+                                        (nlp.model.StandardRNN('lstm', vocab_size, 16, 16, 2),
+                                         1, 0)]:
+        model.initialize()
+        with mx.autograd.record():
+            output, _, encoded_raw, encoded_dropped = model.forward_with_encoded(inputs)
+            assert len(model(inputs)) == 2
+        assert output.shape == (6, 5, vocab_size)
+        assert len(encoded_raw) == num_raw
+        assert len(encoded_dropped) == num_dropped
+        assert len(model(inputs)) == 2